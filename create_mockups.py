@@ -2,6 +2,7 @@ import os
 import argparse
 import cv2
 import json
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import numpy as np
 from skimage import io
@@ -13,10 +14,7 @@ def load_parameters(path):
         parameters = json.load(file)
     return parameters
 
-def create_mockup(mockup_path, design_path, output_path, bbox, width, height, rotation):
-    mockup = Image.open(mockup_path)
-    design = Image.open(design_path)
-
+def place_design(mockup, design, bbox, width, height, rotation):
     aspect_ratio = design.height / design.width
     design_width = width
     design_height = int(width * aspect_ratio)
@@ -31,18 +29,61 @@ def create_mockup(mockup_path, design_path, output_path, bbox, width, height, ro
     position = (int(bbox[1] + width / 2 - design.width / 2), int(bbox[0]))
 
     mockup.paste(design, position, design)
+
+def create_mockup(mockup_path, design_path, output_path, bbox, width, height, rotation):
+    mockup = Image.open(mockup_path)
+    design = Image.open(design_path)
+    place_design(mockup, design, bbox, width, height, rotation)
     mockup.save(output_path)
 
-def create_mockups(design_dir, mockup_dir, parameters, output_dir):
+def create_mockup_batch(mockup_path, design_paths, output_paths, bbox, width, height, rotation):
+    # Decodes the mockup once and places every design on a copy of it.
+    mockup = Image.open(mockup_path)
+    mockup.load()
+    for design_path, output_path in zip(design_paths, output_paths):
+        result = mockup.copy()
+        place_design(result, Image.open(design_path), bbox, width, height, rotation)
+        result.save(output_path)
+
+def split_batch(items, parts):
+    # Splits items into at most `parts` consecutive chunks of near-equal size.
+    size = max(1, -(-len(items) // max(1, parts)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def output_filename(design_filename, mockup_filename):
+    return f"{os.path.splitext(design_filename)[0]}_{os.path.splitext(mockup_filename)[0]}.png"
+
+def create_mockups(design_dir, mockup_dir, parameters, output_dir, parallel=False):
+    # With parallel=True the batches are submitted as tasks to a process
+    # pool; the image work is CPU-bound and holds the GIL, so threads would
+    # not help here.
     os.makedirs(output_dir, exist_ok=True)
 
-    for design_filename in os.listdir(design_dir):
-        if design_filename.endswith(".png") or design_filename.endswith(".jpg"):  
-            design_path = os.path.join(design_dir, design_filename)
-            for mockup_filename, params in parameters.items():
-                mockup_path = os.path.join(mockup_dir, mockup_filename)
-                output_path = os.path.join(output_dir, f"{os.path.splitext(design_filename)[0]}_{os.path.splitext(mockup_filename)[0]}.png")
-                create_mockup(mockup_path, design_path, output_path, params["bbox"], params["width"], params["height"], params["rotation"])
+    with os.scandir(design_dir) as entries:
+        designs = [(entry.name, entry.path) for entry in entries if entry.name.endswith((".png", ".jpg"))]
+
+    # One batch per mockup, so each mockup image is decoded only once. In
+    # parallel, each batch is split once per core so that a few mockups with
+    # many designs still keep every core busy.
+    workers = os.cpu_count() or 1
+    parts = workers if parallel else 1
+    design_paths = [design_path for _, design_path in designs]
+    jobs = []
+    for mockup_filename, params in parameters.items():
+        mockup_path = os.path.join(mockup_dir, mockup_filename)
+        output_paths = [os.path.join(output_dir, output_filename(design_filename, mockup_filename)) for design_filename, _ in designs]
+        for design_batch, output_batch in zip(split_batch(design_paths, parts), split_batch(output_paths, parts)):
+            jobs.append((mockup_path, design_batch, output_batch, params["bbox"], params["width"], params["height"], params["rotation"]))
+
+    if parallel:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(create_mockup_batch, *job) for job in jobs]:
+                future.result()
+    else:
+        for job in jobs:
+            create_mockup_batch(*job)
+
+    return sorted({os.path.basename(path) for job in jobs for path in job[2]}, key=str.lower)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Create mockup designs based on given parameters.")
@@ -50,7 +91,8 @@ if __name__ == "__main__":
     parser.add_argument('--design_dir', type=str, default='images/designs', help="Directory of design images.")
     parser.add_argument('--mockup_dir', type=str, default='images/mockups', help="Directory of mockup images.")
     parser.add_argument('--output_dir', type=str, default='images/output', help="Directory to save the output images.")
+    parser.add_argument('--parallel', action='store_true', help="Create the mockups in parallel on all CPU cores.")
     args = parser.parse_args()
 
     parameters = load_parameters(args.param_file)
-    create_mockups(args.design_dir, args.mockup_dir, parameters, args.output_dir)
+    create_mockups(args.design_dir, args.mockup_dir, parameters, args.output_dir, parallel=args.parallel)
@@ -0,0 +1,19 @@
+import os
+
+# A few threaded workers: each worker also runs its own image-processing
+# pool, sized in web_app.py to its share of the CPU cores.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = 4
+worker_tmp_dir = "/dev/shm"
+timeout = 300
+
+# Workers inherit this, so web_app.py can split the cores between them.
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+
+def post_fork(server, worker):
+    # Each worker expires old jobs and keeps its own in-progress jobs fresh.
+    from web_app import start_sweeper
+
+    start_sweeper()
@@ -1,37 +1,194 @@
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import threading
+import time
 import uuid
-from typing import Dict, Tuple
-
-from flask import Flask, request, send_from_directory, render_template_string
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+from flask import Flask, abort, jsonify, request, send_from_directory
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 
 from calculate_box_pos import calculate_parameters
-from create_mockups import create_mockups
+from create_mockups import create_mockup_batch, output_filename, split_batch
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 RUNS_DIR = os.path.join(BASE_DIR, "runs")
-os.makedirs(RUNS_DIR, exist_ok=True)
-
-ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+BOXES_DIR = os.path.join(RUNS_DIR, "_boxes")
+os.makedirs(BOXES_DIR, exist_ok=True)
+
+ALLOWED_EXTENSIONS = (".png", ".jpg", ".jpeg")
+MAX_CONTENT_LENGTH = 512 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+COLOR_FIELDS = ("hex_color", "r", "g", "b")
+COLOR_FIELD_MAX_SIZE = 64
+# Leaves room for the ".part" suffix and for output names, which join a design
+# and a mockup name, within the usual 255-byte filename limit.
+MAX_FILENAME_LENGTH = 100
+HEX_COLOR_RE = re.compile(r"^#?([0-9a-fA-F]{6})$")
+PIPELINE_QUEUE_SIZE = 8
+PARAMETER_CACHE_SIZE = 256
+OUTPUT_MAX_AGE = 365 * 24 * 60 * 60
+JOB_STATUS_FILENAME = "job.json"
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+JOB_TTL = int(os.environ.get("JOB_TTL_SECONDS", 30 * 60))
+# Short enough that in-progress jobs are touched several times per TTL.
+SWEEP_INTERVAL = max(1, min(5 * 60, JOB_TTL // 3))
+# In-progress jobs are touched every SWEEP_INTERVAL, so a job directory left
+# untouched for longer than this belongs to a server process that went away.
+JOB_STALE_AFTER = 2 * SWEEP_INTERVAL
+# Every server process has its own pool, so split the cores between them.
+POOL_WORKERS = max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", 1)))
 
 
 def allowed_file(filename: str) -> bool:
-    if not filename:
-        return False
-    ext = os.path.splitext(filename)[1].lower()
-    return ext in ALLOWED_EXTENSIONS
+    return bool(filename) and filename.lower().endswith(ALLOWED_EXTENSIONS)
+
+
+@functools.lru_cache(maxsize=1024)
+def safe_filename(filename: str) -> str:
+    # Uploads keep reusing the same names, so skip re-running the sanitizer.
+    filename = secure_filename(filename)
+    if len(filename) > MAX_FILENAME_LENGTH:
+        stem, ext = os.path.splitext(filename)
+        filename = stem[: max(0, MAX_FILENAME_LENGTH - len(ext))] + ext[:MAX_FILENAME_LENGTH]
+    return filename
+
+
+class UploadTarget(BaseTarget):
+    """Writes every file part of a multipart field straight into ``target_dir``."""
+
+    def __init__(self, target_dir: str, on_saved: Optional[Callable[..., None]] = None):
+        super().__init__()
+        self.target_dir = target_dir
+        self.on_saved = on_saved
+        self.received = 0
+        self.saved: List[str] = []
+        self._file = None
+
+    def on_start(self):
+        if not self.multipart_filename:
+            return
+        self.received += 1
+        filename = safe_filename(self.multipart_filename)
+        if not allowed_file(filename):
+            return
+        self._file = self.open_file(filename)
+        self.saved.append(filename)
+
+    def open_file(self, filename: str):
+        # Parser chunks are already large, so write them straight to the file
+        # descriptor instead of allocating a write buffer for every upload.
+        return open(os.path.join(self.target_dir, filename), "wb", buffering=0)
+
+    def on_data_received(self, chunk: bytes):
+        if self._file is not None:
+            view = memoryview(chunk)
+            while view:
+                view = view[self._file.write(view):]
+
+    def on_finish(self):
+        if self._file is not None:
+            self.close()
+            self.file_saved(self.saved[-1])
+
+    def file_saved(self, filename: str):
+        if self.on_saved is not None:
+            self.on_saved(filename)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class BoxUploadTarget(UploadTarget):
+    """Stores box mockups once per content under ``BOXES_DIR`` and links them into the job.
+
+    Box mockups rarely change between jobs, so a re-uploaded file replaces no
+    data on disk and its digest lets ``analyze_box`` reuse the earlier result.
+    """
+
+    def __init__(self, target_dir: str, on_saved: Optional[Callable[..., None]] = None):
+        super().__init__(target_dir, on_saved)
+        self._digest = None
+
+    def part_path(self, filename: str) -> str:
+        return os.path.join(self.target_dir, f".{filename}.part")
+
+    def open_file(self, filename: str):
+        self._digest = hashlib.blake2b(digest_size=16)
+        return open(self.part_path(filename), "wb", buffering=0)
+
+    def on_data_received(self, chunk: bytes):
+        if self._file is not None:
+            self._digest.update(chunk)
+        super().on_data_received(chunk)
+
+    def file_saved(self, filename: str):
+        digest = self._digest.hexdigest()
+        shared_dir = os.path.join(BOXES_DIR, digest)
+        shared_path = os.path.join(shared_dir, filename)
+        try:
+            # Keep reused boxes from expiring, see sweep_runs().
+            os.utime(shared_dir)
+            reused = os.path.exists(shared_path)
+        except FileNotFoundError:
+            # Never stored, or just removed by a sweeper in another process.
+            reused = False
+        if reused:
+            os.remove(self.part_path(filename))
+        else:
+            os.makedirs(shared_dir, exist_ok=True)
+            os.replace(self.part_path(filename), shared_path)
+
+        link_path = os.path.join(self.target_dir, filename)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(shared_path, link_path)
+
+        if self.on_saved is not None:
+            self.on_saved(filename, digest)
+
+
+class FieldTarget(ValueTarget):
+    """A ``ValueTarget`` that remembers whether its field has fully arrived.
+
+    Fields are held in memory, so their size is capped at ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size: int = COLOR_FIELD_MAX_SIZE):
+        super().__init__(validator=MaxSizeValidator(max_size))
+        self.finished = False
+
+    def on_finish(self):
+        self.finished = True
+
+    @property
+    def text(self) -> str:
+        return self.value.decode("utf-8", "replace")
 
 
 def parse_color(form) -> Tuple[int, int, int]:
     hex_color = (form.get("hex_color") or "").strip()
     if hex_color:
-        hex_color = hex_color.lstrip("#")
-        if len(hex_color) != 6:
-            raise ValueError("Hex color must have 6 characters.")
-        r = int(hex_color[0:2], 16)
-        g = int(hex_color[2:4], 16)
-        b = int(hex_color[4:6], 16)
+        match = HEX_COLOR_RE.match(hex_color)
+        if not match:
+            raise ValueError("Hex color must have 6 hex digits, for example #000000.")
+        r, g, b = bytes.fromhex(match.group(1))
         return r, g, b
 
     r = int(form.get("r"))
@@ -40,24 +197,401 @@ def parse_color(form) -> Tuple[int, int, int]:
     return r, g, b
 
 
-def build_parameters(box_dir: str, target_color: Tuple[int, int, int]) -> Dict[str, Dict]:
-    parameters: Dict[str, Dict] = {}
-    for filename in os.listdir(box_dir):
-        if not allowed_file(filename):
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    # Created lazily so each server worker process starts its own pool once
+    # and reuses it for every request. The server process runs threads, so
+    # pool workers are started from a clean forkserver (or spawned) rather
+    # than forked from it.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _executor = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=multiprocessing.get_context(method),
+            )
+    return _executor
+
+
+def submit(fn, *args) -> Future:
+    """Submits ``fn`` to the shared pool, replacing the pool if a worker died."""
+    global _executor
+    executor = get_executor()
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        with _executor_lock:
+            if _executor is executor:
+                _executor = None
+        return get_executor().submit(fn, *args)
+
+
+# Results of calculate_parameters() keyed by (content digest, target color),
+# so box mockups that are uploaded again in later jobs are not re-analyzed.
+_parameter_cache: "OrderedDict[Tuple[str, Tuple[int, int, int]], Tuple]" = OrderedDict()
+_parameter_cache_lock = threading.Lock()
+
+
+def cached_parameters(digest: str, target_color: Tuple[int, int, int]) -> Optional[Tuple]:
+    with _parameter_cache_lock:
+        result = _parameter_cache.get((digest, target_color))
+        if result is not None:
+            _parameter_cache.move_to_end((digest, target_color))
+        return result
+
+
+def store_parameters(digest: str, target_color: Tuple[int, int, int], result: Tuple):
+    with _parameter_cache_lock:
+        _parameter_cache[(digest, target_color)] = result
+        _parameter_cache.move_to_end((digest, target_color))
+        while len(_parameter_cache) > PARAMETER_CACHE_SIZE:
+            _parameter_cache.popitem(last=False)
+
+
+def analyze_box(path: str, target_color: Tuple[int, int, int], digest: str) -> Future:
+    """Returns a future for ``calculate_parameters``, served from the cache when possible."""
+    result = cached_parameters(digest, target_color)
+    if result is not None:
+        future: Future = Future()
+        future.set_result(result)
+        return future
+
+    def remember(done: Future):
+        if not done.cancelled() and done.exception() is None:
+            store_parameters(digest, target_color, done.result())
+
+    future = submit(calculate_parameters, path, target_color)
+    future.add_done_callback(remember)
+    return future
+
+
+def box_parameters(bbox, height, width, rotation) -> Optional[Dict]:
+    if not (bbox and height and width):
+        return None
+    return {
+        "bbox": bbox,
+        "height": height,
+        "width": width,
+        "rotation": rotation,
+    }
+
+
+_DONE = object()
+_CANCELLED = object()
+
+
+class MockupPipeline:
+    """Analyzes box mockups and composes outputs while the upload is still arriving.
+
+    The request thread is the save stage and reports each file once it is on
+    disk. An analyze thread hands box mockups to the process pool, and a
+    compose thread renders each design/mockup pair as soon as the design, the
+    mockup and its box parameters are all available. Finished analyses are
+    delivered to the compose thread from future callbacks, in completion
+    order, so neither stage ever waits on a single box. The request thread
+    only waits when the bounded analyze queue is full, which the analyze
+    thread drains quickly since it just submits work to the pool.
+    """
+
+    def __init__(self, box_dir: str, mockup_dir: str, design_dir: str, output_dir: str):
+        self.box_dir = box_dir
+        self.mockup_dir = mockup_dir
+        self.design_dir = design_dir
+        self.output_dir = output_dir
+        self.target_color: Optional[Tuple[int, int, int]] = None
+        self.parameters: Dict[str, Dict] = {}
+        self._pending_boxes: List[Tuple[str, str]] = []
+        self._analyze_queue: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        # Unbounded: it is fed from pool callbacks, which must never block, and
+        # the compose thread only submits work so it always keeps up.
+        self._compose_queue: queue.Queue = queue.Queue()
+        self.on_done: Optional[Callable[["MockupPipeline"], None]] = None
+        self._outputs: List[str] = []
+        self._error: Optional[BaseException] = None
+        self._cancelled = False
+        self._futures: List[Future] = []
+        self._futures_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._analyze_worker, daemon=True),
+            threading.Thread(target=self._compose_worker, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def set_target_color(self, target_color: Tuple[int, int, int]):
+        self.target_color = target_color
+        for box in self._pending_boxes:
+            self._analyze_queue.put(box)
+        self._pending_boxes = []
+
+    def box_saved(self, filename: str, digest: str):
+        # Boxes can only be analyzed once the target color is known.
+        if self.target_color is None:
+            self._pending_boxes.append((filename, digest))
+        else:
+            self._analyze_queue.put((filename, digest))
+
+    def mockup_saved(self, filename: str):
+        self._compose_queue.put(("mockup", filename))
+
+    def design_saved(self, filename: str):
+        self._compose_queue.put(("design", filename))
+
+    @property
+    def outputs(self) -> List[str]:
+        return self._outputs
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        return self._error
+
+    def finish(self):
+        """Signals that every file has been saved; ``on_done`` runs once the stages drain."""
+        self._analyze_queue.put(_DONE)
+
+    def cancel(self):
+        """Stops both stages without waiting; queued pool work is dropped and ``on_done`` never runs."""
+        with self._futures_lock:
+            self._cancelled = True
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.cancel()
+        self._compose_queue.put((_CANCELLED,))
+        self._analyze_queue.put(_DONE)
+
+    def _track(self, future: Future) -> Future:
+        # Futures submitted after cancel() has collected the others are
+        # cancelled right away.
+        with self._futures_lock:
+            cancelled = self._cancelled
+            if not cancelled:
+                self._futures.append(future)
+        if cancelled:
+            future.cancel()
+        return future
+
+    def _analyze_worker(self):
+        submitted = 0
+        while (box := self._analyze_queue.get()) is not _DONE:
+            if self._cancelled:
+                continue
+            try:
+                filename, digest = box
+                future = self._track(analyze_box(os.path.join(self.box_dir, filename), self.target_color, digest))
+                future.add_done_callback(functools.partial(self._box_analyzed, filename))
+                submitted += 1
+            except BaseException as exc:
+                self._error = self._error or exc
+        # Results may still be on their way, so tell the compose thread how
+        # many to wait for.
+        self._compose_queue.put((_DONE, submitted))
+
+    def _box_analyzed(self, filename: str, future: Future):
+        self._compose_queue.put(("box", filename, future))
+
+    def _compose_worker(self):
+        designs: List[str] = []
+        mockups = set()
+        renders = []
+
+        def compose(batch: List[str], mockup: str):
+            # Each task decodes the mockup once for its share of the designs;
+            # splitting the batch across the pool keeps every core busy when
+            # there are few mockups.
+            params = self.parameters[mockup]
+            for designs_part in split_batch(batch, POOL_WORKERS):
+                names = [output_filename(design, mockup) for design in designs_part]
+                future = self._track(submit(
+                    create_mockup_batch,
+                    os.path.join(self.mockup_dir, mockup),
+                    [os.path.join(self.design_dir, design) for design in designs_part],
+                    [os.path.join(self.output_dir, name) for name in names],
+                    params["bbox"],
+                    params["width"],
+                    params["height"],
+                    params["rotation"],
+                ))
+                renders.append((names, future))
+
+        # Each pair is composed exactly once, when the last of its design,
+        # mockup and box parameters arrives. Box futures arrive here already
+        # finished, so nothing in this loop waits on the pool.
+        expected_boxes = None
+        analyzed_boxes = 0
+        while expected_boxes is None or analyzed_boxes < expected_boxes:
+            item = self._compose_queue.get()
+            if self._cancelled:
+                return
+            if item[0] is _DONE:
+                expected_boxes = item[1]
+                continue
+            kind, filename = item[0], item[1]
+            if kind == "box":
+                analyzed_boxes += 1
+            try:
+                if kind == "design" and filename not in designs:
+                    designs.append(filename)
+                    for mockup in mockups.intersection(self.parameters):
+                        compose([filename], mockup)
+                elif kind == "mockup" and filename not in mockups:
+                    mockups.add(filename)
+                    if filename in self.parameters and designs:
+                        compose(list(designs), filename)
+                elif kind == "box" and filename not in self.parameters:
+                    params = box_parameters(*item[2].result())
+                    if params:
+                        self.parameters[filename] = params
+                        if filename in mockups and designs:
+                            compose(list(designs), filename)
+            except BaseException as exc:
+                self._error = self._error or exc
+
+        outputs = []
+        for names, future in renders:
+            try:
+                future.result()
+                outputs.extend(names)
+            except BaseException as exc:
+                self._error = self._error or exc
+        self._outputs = sorted(outputs, key=str.lower)
+        if self.on_done is not None:
+            self.on_done(self)
+
+
+# Jobs still uploading or running in this process, keyed by job id. Finished
+# jobs are recorded in their job directory so any server process can report
+# them.
+_jobs: Dict[str, MockupPipeline] = {}
+_jobs_lock = threading.Lock()
+
+
+def job_finished(job_id: str, job_dir: str, pipeline: MockupPipeline):
+    try:
+        error = None
+        if pipeline.error is not None:
+            # The exception can mention server paths, so only log it.
+            app.logger.error("Job %s failed", job_id, exc_info=pipeline.error)
+            error = "Mockup generation failed. Check that all uploads are valid PNG or JPG images."
+        elif not pipeline.parameters:
+            error = "Could not detect any target boxes in the box mockups."
+        elif not pipeline.outputs:
+            error = "No output images were generated. Check that filenames match between mockups and box mockups."
+
+        status = {"done": True, "outputs": [] if error else pipeline.outputs, "error": error}
+        path = os.path.join(job_dir, JOB_STATUS_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(status, f)
+        os.replace(path + ".tmp", path)
+    except Exception:
+        app.logger.exception("Could not record the result of job %s", job_id)
+    finally:
+        with _jobs_lock:
+            _jobs.pop(job_id, None)
+
+
+def touch_job(job_id: str):
+    """Refreshes the mtimes ``sweep_runs`` checks for a job that is still in progress.
+
+    Uploads and outputs are written into subdirectories, which leaves the job
+    directory's own mtime untouched, and sweepers in other server processes
+    cannot see this process's ``_jobs``.
+    """
+    job_dir = os.path.join(RUNS_DIR, job_id)
+    os.utime(job_dir)
+    with os.scandir(os.path.join(job_dir, "box_mockups")) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                try:
+                    os.utime(os.path.dirname(os.readlink(entry.path)))
+                except FileNotFoundError:
+                    continue
+
+
+def sweep_runs():
+    """Removes job directories and shared box mockups older than ``JOB_TTL``."""
+    cutoff = time.time() - JOB_TTL
+    with _jobs_lock:
+        active = set(_jobs)
+
+    for job_id in active:
+        try:
+            touch_job(job_id)
+        except FileNotFoundError:
             continue
-        image_path = os.path.join(box_dir, filename)
-        bbox, height, width, rotation = calculate_parameters(image_path, target_color)
-        if bbox and height and width:
-            parameters[filename] = {
-                "bbox": bbox,
-                "height": height,
-                "width": width,
-                "rotation": rotation,
-            }
-    return parameters
+
+    for parent in (RUNS_DIR, BOXES_DIR):
+        with os.scandir(parent) as entries:
+            for entry in entries:
+                if entry.path == BOXES_DIR or entry.name in active or not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    expired = entry.stat(follow_symlinks=False).st_mtime < cutoff
+                except FileNotFoundError:
+                    continue
+                if expired:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _sweeper():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep_runs()
+        except Exception:
+            app.logger.exception("Failed to remove expired jobs")
+
+
+_sweeper_thread: Optional[threading.Thread] = None
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper():
+    """Starts the thread that expires old jobs; called once per server process.
+
+    The development server starts it from ``__main__`` and Gunicorn workers
+    from the ``post_fork`` hook in ``gunicorn.conf.py``, so importing this
+    module never starts deleting files.
+    """
+    global _sweeper_thread
+    with _sweeper_lock:
+        if _sweeper_thread is None:
+            _sweeper_thread = threading.Thread(target=_sweeper, daemon=True)
+            _sweeper_thread.start()
+
+
+def job_status_for(job_id: str) -> Optional[Dict]:
+    if not JOB_ID_RE.fullmatch(job_id):
+        return None
+    with _jobs_lock:
+        if job_id in _jobs:
+            return {"done": False, "outputs": [], "error": None}
+
+    job_dir = os.path.join(RUNS_DIR, job_id)
+    try:
+        with open(os.path.join(job_dir, JOB_STATUS_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+
+    # The job may still be running in another server process.
+    try:
+        modified = os.stat(job_dir).st_mtime
+    except FileNotFoundError:
+        return None
+    if modified < time.time() - JOB_STALE_AFTER:
+        return {"done": True, "outputs": [], "error": "The job stopped before it finished. Please upload the files again."}
+    return {"done": False, "outputs": [], "error": None}
 
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = OUTPUT_MAX_AGE
+# Only enable X-Sendfile behind a front-end server (e.g. nginx) that handles it.
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
 
 
 TEMPLATE = """
@@ -94,7 +628,34 @@ TEMPLATE = """
       <div class="error">{{ error }}</div>
     {% endif %}
 
-    {% if outputs %}
+    {% if processing %}
+      <h2>Generating mockups&hellip;</h2>
+      <p>This page updates automatically when your mockups are ready.</p>
+      <script>
+        (function poll() {
+          fetch("{{ url_for('job_status', job_id=job_id) }}")
+            .then(function (response) {
+              // The job is gone or the server failed: stop polling and show the job page.
+              if (!response.ok) {
+                window.location = "{{ url_for('job_page', job_id=job_id) }}";
+                return null;
+              }
+              return response.json();
+            })
+            .then(function (status) {
+              if (status === null) {
+                return;
+              }
+              if (status.done) {
+                window.location = "{{ url_for('job_page', job_id=job_id) }}";
+              } else {
+                setTimeout(poll, 1000);
+              }
+            })
+            .catch(function () { setTimeout(poll, 2000); });
+        })();
+      </script>
+    {% elif outputs %}
       <h2>Generated mockups</h2>
       <div class="gallery">
         {% for image in outputs %}
@@ -106,7 +667,22 @@ TEMPLATE = """
       </div>
       <a class="back-link" href="{{ url_for('index') }}">Generate more mockups</a>
     {% else %}
-      <form method="post" enctype="multipart/form-data">
+      <form method="post" action="{{ url_for('index') }}" enctype="multipart/form-data">
+        <div class="field">
+          <label>Target color</label>
+          <div class="hint">Use either HEX or RGB. If HEX is filled, it is used.</div>
+          <div style="display: grid; grid-template-columns: 2fr 3fr; gap: 12px; align-items: center;">
+            <div>
+              <input type="text" name="hex_color" placeholder="#000000">
+            </div>
+            <div style="display: grid; grid-template-columns: repeat(3, 1fr); gap: 8px;">
+              <input type="number" name="r" min="0" max="255" placeholder="R">
+              <input type="number" name="g" min="0" max="255" placeholder="G">
+              <input type="number" name="b" min="0" max="255" placeholder="B">
+            </div>
+          </div>
+        </div>
+
         <div class="field">
           <label for="designs">Design images</label>
           <input id="designs" type="file" name="designs" multiple required>
@@ -125,21 +701,6 @@ TEMPLATE = """
           <div class="hint">Reference mockups with a solid color box showing where the design goes.</div>
         </div>
 
-        <div class="field">
-          <label>Target color</label>
-          <div class="hint">Use either HEX or RGB. If HEX is filled, it is used.</div>
-          <div style="display: grid; grid-template-columns: 2fr 3fr; gap: 12px; align-items: center;">
-            <div>
-              <input type="text" name="hex_color" placeholder="#000000">
-            </div>
-            <div style="display: grid; grid-template-columns: repeat(3, 1fr); gap: 8px;">
-              <input type="number" name="r" min="0" max="255" placeholder="R">
-              <input type="number" name="g" min="0" max="255" placeholder="G">
-              <input type="number" name="b" min="0" max="255" placeholder="B">
-            </div>
-          </div>
-        </div>
-
         <button class="button" type="submit">Generate mockups</button>
       </form>
     {% endif %}
@@ -148,31 +709,14 @@ TEMPLATE = """
 </html>
 """
 
+# Compiled once at import instead of being looked up on every render.
+_TPL = app.jinja_env.from_string(TEMPLATE)
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "GET":
-        return render_template_string(TEMPLATE, error=None, outputs=None, job_id=None)
-
-    try:
-        target_color = parse_color(request.form)
-    except Exception as exc:
-        return render_template_string(TEMPLATE, error=str(exc), outputs=None, job_id=None), 400
-
-    box_files = request.files.getlist("box_mockups")
-    mockup_files = request.files.getlist("mockups")
-    design_files = request.files.getlist("designs")
-
-    if not box_files or not mockup_files or not design_files:
-        return (
-            render_template_string(
-                TEMPLATE,
-                error="Please upload at least one file for designs, mockups, and box mockups.",
-                outputs=None,
-                job_id=None,
-            ),
-            400,
-        )
+        return _TPL.render(error=None, outputs=None, job_id=None)
 
     job_id = uuid.uuid4().hex
     job_dir = os.path.join(RUNS_DIR, job_id)
@@ -186,78 +730,118 @@ def index():
     os.makedirs(design_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
 
-    def save_files(files, target_dir):
-        saved_any = False
-        for f in files:
-            if not f or not f.filename:
-                continue
-            filename = secure_filename(f.filename)
-            if not allowed_file(filename):
-                continue
-            path = os.path.join(target_dir, filename)
-            f.save(path)
-            saved_any = True
-        return saved_any
-
-    saved_designs = save_files(design_files, design_dir)
-    saved_mockups = save_files(mockup_files, mockup_dir)
-    saved_boxes = save_files(box_files, box_dir)
-
-    if not (saved_designs and saved_mockups and saved_boxes):
-        return (
-            render_template_string(
-                TEMPLATE,
-                error="No valid image files found. Use PNG or JPG files.",
-                outputs=None,
-                job_id=None,
-            ),
-            400,
-        )
-
-    parameters = build_parameters(box_dir, target_color)
-    if not parameters:
-        return (
-            render_template_string(
-                TEMPLATE,
-                error="Could not detect any target boxes in the box mockups.",
-                outputs=None,
-                job_id=None,
-            ),
-            400,
-        )
-
-    create_mockups(design_dir, mockup_dir, parameters, output_dir)
-
-    outputs = sorted(
-        [name for name in os.listdir(output_dir) if allowed_file(name)],
-        key=str.lower,
-    )
-
-    if not outputs:
-        return (
-            render_template_string(
-                TEMPLATE,
-                error="No output images were generated. Check that filenames match between mockups and box mockups.",
-                outputs=None,
-                job_id=None,
-            ),
-            400,
-        )
-
-    return render_template_string(
-        TEMPLATE,
-        error=None,
-        outputs=outputs,
-        job_id=job_id,
-    )
+    pipeline = MockupPipeline(box_dir, mockup_dir, design_dir, output_dir)
+    with _jobs_lock:
+        _jobs[job_id] = pipeline
+    uploads = {
+        "designs": UploadTarget(design_dir, pipeline.design_saved),
+        "mockups": UploadTarget(mockup_dir, pipeline.mockup_saved),
+        "box_mockups": BoxUploadTarget(box_dir, pipeline.box_saved),
+    }
+    fields = {name: FieldTarget() for name in COLOR_FIELDS}
+
+    def read_color():
+        return parse_color({name: target.text for name, target in fields.items()})
+
+    def stop():
+        pipeline.cancel()
+        with _jobs_lock:
+            _jobs.pop(job_id, None)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    def cancel(message):
+        stop()
+        return _TPL.render(error=message, outputs=None, job_id=None), 400
+
+    # The form sends the color fields first, which lets box analysis start
+    # while the remaining files are still uploading.
+    color_error = None
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        for name, target in {**uploads, **fields}.items():
+            parser.register(name, target)
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            parser.data_received(chunk)
+            if pipeline.target_color is None and all(target.finished for target in fields.values()):
+                try:
+                    pipeline.set_target_color(read_color())
+                except ValueError as exc:
+                    color_error = str(exc)
+                    break
+    except HTTPException:
+        # Keep Werkzeug's status, e.g. 413 once MAX_CONTENT_LENGTH is exceeded.
+        stop()
+        raise
+    except ValidationError:
+        return cancel("The color fields are too long.")
+    except Exception:
+        # The exception can mention server paths or parser internals, so only log it.
+        app.logger.exception("Could not read the uploads for job %s", job_id)
+        return cancel("Could not read the uploaded files.")
+    finally:
+        for target in uploads.values():
+            target.close()
+
+    if color_error is not None:
+        return cancel(color_error)
+
+    if pipeline.target_color is None:
+        try:
+            pipeline.set_target_color(read_color())
+        except Exception as exc:
+            return cancel(str(exc))
+
+    if not all(target.received for target in uploads.values()):
+        return cancel("Please upload at least one file for designs, mockups, and box mockups.")
+
+    if not all(target.saved for target in uploads.values()):
+        return cancel("No valid image files found. Use PNG or JPG files.")
+
+    # Box analysis and compositing keep running in the background; the
+    # browser polls job_status() until the job is done.
+    pipeline.on_done = lambda finished: job_finished(job_id, job_dir, finished)
+    pipeline.finish()
+
+    return _TPL.render(error=None, outputs=None, job_id=job_id, processing=True), 202
+
+
+@app.route("/jobs/<job_id>")
+def job_page(job_id: str):
+    status = job_status_for(job_id)
+    if status is None:
+        abort(404)
+    if not status["done"]:
+        return _TPL.render(error=None, outputs=None, job_id=job_id, processing=True)
+    return _TPL.render(error=status["error"], outputs=status["outputs"], job_id=job_id)
+
+
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id: str):
+    status = job_status_for(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
 
 
 @app.route("/runs/<job_id>/output/<path:filename>")
 def serve_output(job_id: str, filename: str):
+    # Job ids are uuid4 hex strings; anything else cannot name an output directory.
+    if not JOB_ID_RE.fullmatch(job_id):
+        abort(404)
     directory = os.path.join(RUNS_DIR, job_id, "output")
-    return send_from_directory(directory, filename)
+    return send_from_directory(directory, filename, conditional=True)
+
+
+@app.after_request
+def cache_outputs(response):
+    # Every job gets a fresh uuid4 directory, so its outputs never change.
+    if request.endpoint == "serve_output" and response.status_code in (200, 206, 304):
+        response.headers["Cache-Control"] = f"public, max-age={OUTPUT_MAX_AGE}, immutable"
+    return response
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Development server only; production runs through wsgi.py under Gunicorn.
+    start_sweeper()
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1")
 
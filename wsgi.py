@@ -0,0 +1 @@
+from web_app import app